@@ -5,9 +5,9 @@ GCP_REGION = "us-central1"
 GCP_PROJECT = "PROJECT"
 # bucket in which to store the lock file
 GCS_LOCK_BUCKET = "lock-bucket"
-# bucket in which to store sync tokens
-GCS_DATA_BUCKET = "data-bucket"
-# name of the resubscribe tasks queue
+# firestore collection in which to store sync tokens
+FIRESTORE_COLLECTION = "calendupe"
+# name of the tasks queue, used for updates and resubscriptions
 TASKS_QUEUE_NAME = "calendupe-resubscribe"
 
 # secret token for auth, e.g. output of `secrets.token_hex(16)`
@@ -24,3 +24,5 @@ TARGET_CALENDAR_ADDRESS = "you@your.domain"
 MIN_END_TIME = datetime(2022, 1, 1, tzinfo=timezone.utc)
 # if True, resubscribe to the notification channel before it's set to expire
 REMAIN_SUBSCRIBED = False
+# if True, write API latency metrics to Cloud Monitoring after each update. they're always logged
+REPORT_METRICS = False
@@ -0,0 +1,30 @@
+import functools
+from typing import Optional
+
+from google.cloud import firestore
+
+import metrics
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> firestore.Client:
+    return firestore.Client()
+
+
+@metrics.timed("firestore.read_field")
+def read_field(collection: str, document: str, field: str) -> Optional[str]:
+    """
+    Read a single field of a document
+    :return: the field value, or None if the document or field doesn't exist
+    """
+    snapshot = get_client().collection(collection).document(document).get()
+    if not snapshot.exists:
+        return None
+    return (snapshot.to_dict() or {}).get(field)
+
+
+@metrics.timed("firestore.write_field")
+def write_field(collection: str, document: str, field: str, value: str) -> None:
+    """
+    Write a single field of a document, creating the document if needed
+    """
+    get_client().collection(collection).document(document).set({field: value}, merge=True)
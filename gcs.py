@@ -1,45 +1,59 @@
-import io
+import functools
+import random
+import time
 
-import backoff
 from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage
 
-UTF_8 = "utf-8"
+import metrics
 
+# longest total time to wait for the lock
+LOCK_MAX_WAIT_SECONDS = 300
+# caps the sleep before each lock retry at 2^6 = 64 seconds
+LOCK_MAX_BACKOFF_EXPONENT = 6
 
-def upload_text(bucket_name: str, blob_name: str, content: str):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    encoded = content.encode(UTF_8)
-    data = io.BytesIO(encoded)
-    blob.upload_from_file(data)
+@functools.lru_cache(maxsize=None)
+def get_client() -> storage.Client:
+    return storage.Client()
 
 
-def read_text(bucket_name: str, blob_name: str) -> str:
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    content: bytes = blob.download_as_bytes()
-    return content.decode(UTF_8)
+@functools.lru_cache(maxsize=None)
+def get_bucket(bucket_name: str) -> storage.Bucket:
+    return get_client().bucket(bucket_name)
 
 
 class GCSLock:
     def __init__(self, bucket_name: str, blob_name: str, creds=None):
-        storage_client = storage.Client(credentials=creds)
-        self.bucket = storage_client.bucket(bucket_name)
+        if creds is None:
+            self.bucket = get_bucket(bucket_name)
+        else:
+            self.bucket = storage.Client(credentials=creds).bucket(bucket_name)
         self.blob_name = blob_name
 
-    @backoff.on_exception(backoff.expo, exception=PreconditionFailed, max_time=300)
-    def acquire(self) -> None:
+    @metrics.timed("gcs.lock_acquire")
+    def acquire(self, max_wait_seconds: float = LOCK_MAX_WAIT_SECONDS) -> None:
         """
-        Synchronously acquire the lock. Uses exponential backoff with up to 5 minute wait
+        Synchronously acquire the lock. Retries with bounded, fully-jittered exponential backoff so that contending
+        invocations don't retry in lockstep, for up to 5 minutes by default
+        :param max_wait_seconds: longest total time to wait for the lock
         :raises PreconditionFailed: if the lock cannot be acquired
         """
         blob = self.bucket.blob(self.blob_name)
-        data = io.BytesIO(b"")
-        blob.upload_from_file(data, if_generation_match=0)
+        deadline = time.monotonic() + max_wait_seconds
+        attempt = 0
+        while True:
+            try:
+                blob.upload_from_string(b"", if_generation_match=0)
+                return
+            except PreconditionFailed as e:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise e
+                delay = random.uniform(0, 2 ** min(attempt, LOCK_MAX_BACKOFF_EXPONENT))
+                time.sleep(min(delay, remaining))
+                attempt += 1
 
+    @metrics.timed("gcs.lock_release")
     def release(self, allow_nonexistent=False):
         """
         Synchronously release the lock
@@ -1,21 +1,23 @@
-import json
+import functools
 from typing import Optional
-import threading
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 import flask
+import orjson
 from dateutil import parser
 
 import functions_framework
 from google.cloud import tasks_v2
-from google.protobuf import timestamp_pb2
+from google.protobuf import duration_pb2, timestamp_pb2
 from googleapiclient import discovery
-from google.api_core.exceptions import NotFound
 from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
 
 import config
+import firestore_db
 import gcs
+import metrics
 import update
 import subscribe
 
@@ -25,24 +27,56 @@ logger = logging.getLogger("calendupe")
 
 
 LOCK_BLOB_NAME = "calendupe_lock"
-NEXT_TOKEN_BLOB_NAME = "next_sync_token"
+SYNC_TOKEN_DOCUMENT = "sync_token"
+SYNC_TOKEN_FIELD = "token"
 
 CALENDUPE_URL = f"https://{config.GCP_REGION}-{config.GCP_PROJECT}.cloudfunctions.net/calendupe"
 
 MAX_CLOUD_TASK_FUTURE = timedelta(days=29, hours=23)
 
+# must match the --timeout the function is deployed with, see the Readme
+FUNCTION_TIMEOUT = timedelta(seconds=540)
+# well under the function timeout, so an update that waited for the lock still has time to finish and release it
+LOCK_MAX_WAIT = FUNCTION_TIMEOUT / 4
+
+
+class OrjsonModel(JsonModel):
+    """
+    JsonModel that parses response bodies with orjson, which decodes large pages of events much faster than json
+    """
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return super().deserialize(content)
+        if self._data_wrapper and isinstance(body, dict) and "data" in body:
+            body = body["data"]
+        return body
+
+
+@functools.lru_cache(maxsize=None)
+def get_calendar_service() -> discovery.Resource:
+    """
+    Get the Calendar service shared by warm invocations. Its HTTP client isn't thread-safe, so it should only be used
+    while holding the global lock
+    """
+    return discovery.build('calendar', 'v3', model=OrjsonModel(), cache_discovery=False, static_discovery=True)
+
+
+@functools.lru_cache(maxsize=None)
+def get_tasks_client() -> tasks_v2.CloudTasksClient:
+    return tasks_v2.CloudTasksClient()
+
 
 def get_stored_sync_token() -> Optional[str]:
     logger.info("fetching sync token")
-    try:
-        return gcs.read_text(config.GCS_DATA_BUCKET, NEXT_TOKEN_BLOB_NAME)
-    except NotFound:
-        return None
+    return firestore_db.read_field(config.FIRESTORE_COLLECTION, SYNC_TOKEN_DOCUMENT, SYNC_TOKEN_FIELD)
 
 
 def store_next_sync_token(next_sync_token: str) -> None:
     logger.info("storing next sync token")
-    gcs.upload_text(config.GCS_DATA_BUCKET, NEXT_TOKEN_BLOB_NAME, next_sync_token)
+    firestore_db.write_field(config.FIRESTORE_COLLECTION, SYNC_TOKEN_DOCUMENT, SYNC_TOKEN_FIELD, next_sync_token)
 
 
 def perform_update():
@@ -50,12 +84,12 @@ def perform_update():
     Primary cloud entrypoint. Acquires the global lock and performs any updates needed, since the last sync token if
     one is available.
     """
-    events_service = discovery.build('calendar', 'v3').events()
+    events_service = get_calendar_service().events()
 
     # acquire lock
     lock = gcs.GCSLock(config.GCS_LOCK_BUCKET, LOCK_BLOB_NAME)
     logger.info("acquiring lock")
-    lock.acquire()
+    lock.acquire(max_wait_seconds=LOCK_MAX_WAIT.total_seconds())
     logger.info("lock acquired")
     try:
         sync_token = get_stored_sync_token()
@@ -63,13 +97,16 @@ def perform_update():
         next_sync_token = update.duplicate_events(events_service,
                                                   config.SOURCE_CALENDAR_ADDRESS, config.TARGET_CALENDAR_ADDRESS,
                                                   sync_token, min_end_time=config.MIN_END_TIME)
-        store_next_sync_token(next_sync_token)
+        # skip the write when nothing has moved the token on
+        if next_sync_token != sync_token:
+            store_next_sync_token(next_sync_token)
 
     # release lock
     finally:
         logger.info("releasing lock")
-        lock.release()
+        lock.release(allow_nonexistent=True)
         logger.info("lock released")
+        metrics.flush(config.GCP_PROJECT, report=getattr(config, "REPORT_METRICS", False))
 
 
 def perform_resubscribe(watched_resource_id: str):
@@ -90,25 +127,28 @@ def perform_resubscribe(watched_resource_id: str):
                                  ttl_seconds=None)
 
 
-def create_resubscribe_task(watched_resource_id: str, schedule_time: datetime):
+def create_task(path: str, body: dict, schedule_time: datetime,
+                http_method: tasks_v2.HttpMethod = tasks_v2.HttpMethod.POST,
+                dispatch_deadline: Optional[timedelta] = None) -> tasks_v2.Task:
     """
-    Create a Cloud Task to resubscribe to the calendar.
-    :param watched_resource_id: resource ID from the watch
+    Create a Cloud Task that calls back into calendupe.
+    :param path: path to call, relative to the calendupe URL
+    :param body: JSON request body
     :param schedule_time: when to schedule the task for
+    :param http_method: HTTP method for the call
+    :param dispatch_deadline: how long Cloud Tasks waits for a response before retrying. uses the queue default if None
+    :return: the created task
     """
-    tasks_client = tasks_v2.CloudTasksClient()
+    tasks_client = get_tasks_client()
     queue_path = tasks_client.queue_path(config.GCP_PROJECT, config.GCP_REGION, config.TASKS_QUEUE_NAME)
-    body = {
-        "watched_resource_id": watched_resource_id
-    }
     request = {
-        "http_method": tasks_v2.HttpMethod.PATCH,
-        "url": CALENDUPE_URL + "/subscription",
+        "http_method": http_method,
+        "url": CALENDUPE_URL + path,
         "headers": {
             "Content-type": "application/json",
             "X-Goog-Channel-Token": config.TOKEN
         },
-        "body": json.dumps(body).encode('utf-8')
+        "body": orjson.dumps(body)
     }
     task = {
         "http_request": request,
@@ -116,10 +156,35 @@ def create_resubscribe_task(watched_resource_id: str, schedule_time: datetime):
     timestamp = timestamp_pb2.Timestamp()
     timestamp.FromDatetime(schedule_time)
     task['schedule_time'] = timestamp
-    response = tasks_client.create_task(request={"parent": queue_path, "task": task})
+    if dispatch_deadline is not None:
+        duration = duration_pb2.Duration()
+        duration.FromTimedelta(dispatch_deadline)
+        task['dispatch_deadline'] = duration
+    return tasks_client.create_task(request={"parent": queue_path, "task": task})
+
+
+def create_resubscribe_task(watched_resource_id: str, schedule_time: datetime):
+    """
+    Create a Cloud Task to resubscribe to the calendar.
+    :param watched_resource_id: resource ID from the watch
+    :param schedule_time: when to schedule the task for
+    """
+    body = {
+        "watched_resource_id": watched_resource_id
+    }
+    response = create_task("/subscription", body, schedule_time, http_method=tasks_v2.HttpMethod.PATCH)
     logger.info(f"created resubscription task {response.name} scheduled for {response.schedule_time}")
 
 
+def create_update_task():
+    """
+    Create a Cloud Task to perform an update immediately. Running the update as its own request ensures it runs to
+    completion, and Cloud Tasks retries it if it fails.
+    """
+    response = create_task("/update", {}, datetime.now(tz=timezone.utc), dispatch_deadline=FUNCTION_TIMEOUT)
+    logger.info(f"created update task {response.name}")
+
+
 def schedule_resubscribe(expiration: datetime, watched_resource_id: str):
     """
     Schedule a Cloud Task to resubscribe to the calendar 1 hour before the channel expiration.
@@ -137,8 +202,8 @@ def schedule_resubscribe(expiration: datetime, watched_resource_id: str):
 def calendupe(request: flask.Request) -> flask.Response:
     """
     Cloud Function request handler. Parses a push notification from the Calendar API and performs an update. Responds
-    immediately with a 401 if the correct token is not provided, or a 202 otherwise. Asynchronously begins working on
-    update if the resource state is 'exists'
+    immediately with a 401 if the correct token is not provided, or a 202 otherwise. Enqueues an update task if the
+    resource state is 'exists', which calls back into the 'update' path
     """
     # auth
     channel_token = request.headers.get("X-Goog-Channel-Token", None)
@@ -161,6 +226,9 @@ def calendupe(request: flask.Request) -> flask.Response:
             return flask.Response(response="bad request", status=400)
         perform_resubscribe(request.json['watched_resource_id'])
 
+    elif path == "update":
+        perform_update()
+
     elif path == "channel":
         # handle channel
         resource_id = request.headers.get("X-Goog-Resource-ID", None)
@@ -176,8 +244,7 @@ def calendupe(request: flask.Request) -> flask.Response:
         elif resource_state == "not_exists":
             logger.info("Resource does not exist!")
         elif resource_state == "exists":
-            thread = threading.Thread(target=perform_update, name="calendupe-update-thread")
-            thread.start()
+            create_update_task()
         else:
             logger.info(f"Resource state was {resource_state}, doing nothing")
 
@@ -0,0 +1,108 @@
+import bisect
+import contextlib
+import functools
+import logging
+import statistics
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List
+
+from google.api import distribution_pb2
+from google.cloud import monitoring_v3
+
+
+logger = logging.getLogger("calendupe.metrics")
+
+
+METRIC_TYPE = "custom.googleapis.com/calendupe/api_latency"
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKET_BOUNDS_MS = [1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_latencies_ms: Dict[str, List[float]] = defaultdict(list)
+_latencies_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> monitoring_v3.MetricServiceClient:
+    return monitoring_v3.MetricServiceClient()
+
+
+def record(label: str, latency_ms: float) -> None:
+    with _latencies_lock:
+        _latencies_ms[label].append(latency_ms)
+
+
+@contextlib.contextmanager
+def timer(label: str) -> Iterator[None]:
+    """
+    Context manager recording the latency of its body under the given label, whether or not it raises
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(label, (time.perf_counter() - start) * 1000)
+
+
+def timed(label: str) -> Callable:
+    """
+    Decorator recording the latency of each call to the wrapped function under the given label, whether or not it
+    raises
+    """
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _to_distribution(latencies_ms: List[float]) -> distribution_pb2.Distribution:
+    bucket_counts = [0] * (len(LATENCY_BUCKET_BOUNDS_MS) + 1)
+    for latency_ms in latencies_ms:
+        bucket_counts[bisect.bisect_right(LATENCY_BUCKET_BOUNDS_MS, latency_ms)] += 1
+    mean = statistics.fmean(latencies_ms)
+    return distribution_pb2.Distribution(
+        count=len(latencies_ms),
+        mean=mean,
+        sum_of_squared_deviation=sum((latency_ms - mean) ** 2 for latency_ms in latencies_ms),
+        bucket_options={'explicit_buckets': {'bounds': LATENCY_BUCKET_BOUNDS_MS}},
+        bucket_counts=bucket_counts
+    )
+
+
+def flush(project: str, report: bool = True) -> None:
+    """
+    Log a summary of the latencies recorded since the last flush, and write them to Cloud Monitoring as one
+    distribution per label. Failing to write metrics is logged rather than raised
+    :param project: GCP project to write metrics to
+    :param report: if False, only log the summary
+    """
+    global _latencies_ms
+    with _latencies_lock:
+        latencies_ms, _latencies_ms = _latencies_ms, defaultdict(list)
+    if len(latencies_ms) == 0:
+        return
+
+    for label, values in sorted(latencies_ms.items()):
+        logger.info(f"{label}: {len(values)} calls, {sum(values):.0f}ms total, {max(values):.0f}ms max")
+    if not report:
+        return
+
+    now = time.time()
+    interval = monitoring_v3.TimeInterval({'end_time': {'seconds': int(now), 'nanos': int((now % 1) * 10 ** 9)}})
+    series = []
+    for label, values in latencies_ms.items():
+        time_series = monitoring_v3.TimeSeries()
+        time_series.metric.type = METRIC_TYPE
+        time_series.metric.labels['endpoint'] = label
+        time_series.resource.type = "global"
+        time_series.resource.labels['project_id'] = project
+        time_series.points = [monitoring_v3.Point({'interval': interval,
+                                                   'value': {'distribution_value': _to_distribution(values)}})]
+        series.append(time_series)
+    try:
+        get_client().create_time_series(name=f"projects/{project}", time_series=series)
+    except Exception as e:
+        logger.warning(f"failed to write latency metrics: {e}")
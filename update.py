@@ -1,25 +1,80 @@
 import logging
+import random
+import time
 from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 
 from googleapiclient import discovery
 from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest, HttpRequest
+
+import metrics
 
 
 logger = logging.getLogger("calendupe.update")
 
 
 MAX_PAGES = 500
+# largest page size the Calendar API allows for events.list
+MAX_RESULTS_PER_PAGE = 2500
 DEFAULT_TARGET_EVENT_NAME = "busy (personal)"
 DEFAULT_TARGET_EVENT_DESCRIPTION = """created by <a href="https://github.com/rmehyde/calendupe">calendupe</a>"""
 CREATED_BY_KEY = "createdBy"
 CALENDUPE = "calendupe"
 SOURCE_EVENT_KEY = "sourceEventId"
+# shared by every target event rather than rebuilt per event, so must not be mutated
+TARGET_EVENT_REMINDERS = {'useDefault': False, 'overrides': []}
+CALENDAR_BATCH_URI = "https://www.googleapis.com/batch/calendar/v3"
+# maximum number of requests the Calendar API accepts in a single batch
+MAX_BATCH_SIZE = 50
+# times to resend rate limited requests from a batch before giving up on them
+MAX_BATCH_RETRIES = 5
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+def _is_rate_limited(exception: Optional[HttpError]) -> bool:
+    if exception is None or exception.status_code not in (403, 429):
+        return False
+    if exception.status_code == 429:
+        return True
+    details = exception.error_details if isinstance(exception.error_details, list) else []
+    return any(isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS for detail in details)
+
+
+def execute_batched(requests: List[HttpRequest],
+                    label: str) -> List[Tuple[Optional[Dict[str, Any]], Optional[HttpError]]]:
+    """Execute requests through the Calendar batch endpoint, sending up to 50 requests per HTTP call. Requests that are
+    rate limited are resent with jittered exponential backoff, up to 5 times
+
+    :param requests: requests built from a Google Calendar Python Service
+    :param label: metrics label to record the latency of each batch HTTP call under
+    :return: a (response, exception) pair for each request in order, one of which is None
+    """
+    results: List[Tuple[Optional[Dict[str, Any]], Optional[HttpError]]] = [(None, None)] * len(requests)
+
+    def callback(request_id: str, response: Optional[Dict[str, Any]], exception: Optional[HttpError]):
+        results[int(request_id)] = (response, exception)
+
+    pending = list(range(len(requests)))
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        if attempt > 0:
+            logger.info(f"retrying {len(pending)} rate limited requests")
+            time.sleep(random.uniform(0, 2 ** attempt))
+        for start in range(0, len(pending), MAX_BATCH_SIZE):
+            batch = BatchHttpRequest(callback=callback, batch_uri=CALENDAR_BATCH_URI)
+            for i in pending[start:start + MAX_BATCH_SIZE]:
+                batch.add(requests[i], request_id=str(i))
+            with metrics.timer(label):
+                batch.execute()
+        pending = [i for i in pending if _is_rate_limited(results[i][1])]
+        if len(pending) == 0:
+            break
+    return results
 
 
 def list_events(events_service: discovery.Resource, calendar_address: str,
                 sync_token: Optional[str] = None, min_end_time: Optional[datetime] = None,
-                only_calendupe_events=False) -> Tuple[List[Dict[str, Any]], str]:
+                only_calendupe_events=False, show_deleted=False) -> Tuple[List[Dict[str, Any]], str]:
     """List all matching calendar events
     
     :param events_service: a Google Calendar Events Python Service
@@ -27,29 +82,34 @@ def list_events(events_service: discovery.Resource, calendar_address: str,
     :param sync_token: a sync token to use, to fetch changes since the previous token
     :param min_end_time: the minimum time (of event end) of events to match
     :param only_calendupe_events: if True, only list events created by Calendupe
+    :param show_deleted: if True, include cancelled events even when not using a sync token
     :raises HttpError: if the request executes and gets back a bad response
     """
     if min_end_time is not None and min_end_time.tzinfo is None:
         raise ValueError("'min_end_time' parameter must be timezone-aware")
 
     # construct args
-    kwargs = {'calendarId': calendar_address}
+    kwargs = {'calendarId': calendar_address, 'maxResults': MAX_RESULTS_PER_PAGE}
     if min_end_time is not None:
         kwargs['timeMin'] = min_end_time.isoformat()
     if sync_token is not None:
         kwargs['syncToken'] = sync_token
     if only_calendupe_events:
         kwargs['privateExtendedProperty'] = f"{CREATED_BY_KEY}={CALENDUPE}"
+    if show_deleted:
+        kwargs['showDeleted'] = True
 
     logger.info(f"fetching events from {calendar_address}")
     # first request
-    response = events_service.list(**kwargs).execute()
+    with metrics.timer("calendar.list"):
+        response = events_service.list(**kwargs).execute()
     events = response['items']
     total_pages = 1
     # subsequent pages
     while 'nextPageToken' in response.keys() and total_pages <= MAX_PAGES:
         kwargs['pageToken'] = response['nextPageToken']
-        response = events_service.list(**kwargs).execute()
+        with metrics.timer("calendar.list"):
+            response = events_service.list(**kwargs).execute()
         events.extend(response['items'])
         total_pages += 1
     logger.info(f"fetched {len(events)} events from calendar across {total_pages} pages")
@@ -58,22 +118,17 @@ def list_events(events_service: discovery.Resource, calendar_address: str,
     return events, next_sync_token
 
 
-def create_event(events_service: discovery.Resource, calendar_address: str, event: Dict[str, Any]):
-    events_service.insert(calendarId=calendar_address, body=event).execute()
-
-
-def update_event(events_service: discovery.Resource, calendar_address: str, event: Dict[str, Any]):
-    events_service.patch(calendarId=calendar_address, eventId=event['id'], body=event).execute()
-
-
 def delete_all_calendupe_events(events_service: discovery.Resource, calendar_address: str):
     calendupe_events, _ = list_events(events_service, calendar_address=calendar_address, only_calendupe_events=True)
     logging.info(f"removing {len(calendupe_events)} calendupe events from {calendar_address}")
+    requests = [events_service.delete(calendarId=calendar_address, eventId=event['id'])
+                for event in calendupe_events if event['status'] != "cancelled"]
     deleted = 0
-    for event in calendupe_events:
-        if event['status'] != "cancelled":
-            events_service.delete(calendarId=calendar_address, eventId=event['id']).execute()
+    for _, exception in execute_batched(requests, "calendar.delete"):
+        if exception is None:
             deleted += 1
+        else:
+            logger.error(f"failed to remove calendupe event: {exception}")
     logging.info(f"successfully removed {deleted} calendupe events from {calendar_address}")
 
 
@@ -86,42 +141,68 @@ def source_event_to_target_event(source_event: Dict[str, Any], title=DEFAULT_TAR
     :param title: title/summary of the event to return. defaults to "busy (personal)"
     :param description: description of the event to return. defaults to "created by calendupe"
     """
-    target_event = {'status': source_event.get('status', "confirmed")}
-    if target_event['status'] != "cancelled":
-        target_event['start'] = source_event['start']
-        target_event['end'] = source_event['end']
-        target_event['summary'] = title
-        target_event['description'] = description
-        target_event['reminders'] = {'useDefault': False, 'overrides': []}
-    if 'recurrence' in source_event.keys():
-        target_event['recurrence'] = source_event['recurrence']
-
+    status = source_event.get('status', "confirmed")
     extended_properties = {
         CREATED_BY_KEY: CALENDUPE,
         SOURCE_EVENT_KEY: source_event['id']
     }
-    target_event['extendedProperties'] = {'private': extended_properties}
+    if status == "cancelled":
+        target_event = {'status': status, 'extendedProperties': {'private': extended_properties}}
+    else:
+        target_event = {'status': status, 'start': source_event['start'], 'end': source_event['end'],
+                        'summary': title, 'description': description, 'reminders': TARGET_EVENT_REMINDERS,
+                        'extendedProperties': {'private': extended_properties}}
+    if 'recurrence' in source_event:
+        target_event['recurrence'] = source_event['recurrence']
     return target_event
 
 
-def fetch_target_event(events_service: discovery.Resource,
-                       calendar_address: str, source_event_id: str) -> Optional[Dict[str, Any]]:
-    """Given event ID on the source calendar, retrieve an associated event on the target calendar.
+def _index_by_source(target_events: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    by_source = {}
+    for target_event in target_events:
+        source_event_id = target_event.get('extendedProperties', {}).get('private', {}).get(SOURCE_EVENT_KEY)
+        if source_event_id is None:
+            continue
+        if source_event_id in by_source:
+            logger.warning("Found multiple matching target events!! Using first...")
+            continue
+        by_source[source_event_id] = target_event
+    return by_source
+
+
+def fetch_target_events(events_service: discovery.Resource, calendar_address: str,
+                        source_event_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Given event IDs on the source calendar, retrieve the associated events on the target calendar using batched
+    requests, keyed by source event ID.
 
     :param events_service: a Google Calendar Events Python Service
     :param calendar_address: address of the target calendar, e.g. 'primary' or 'you@your.domain'
-    :param source_event_id: event ID of the event on the source calendar
+    :param source_event_ids: event IDs of the events on the source calendar
+    :raises HttpError: if any of the lookups gets back a bad response
     """
-    request = events_service.list(calendarId=calendar_address, showDeleted=True,
-                                  # would be nice to have the createdBy param too, but can't figure how to pass multiple
-                                  privateExtendedProperty=f"{SOURCE_EVENT_KEY}={source_event_id}")
-    matches = request.execute()['items']
-    if len(matches) == 0:
-        return None
-    elif len(matches) > 1:
-        logger.warning("Found multiple matching target events!! Using first...")
+    # would be nice to have the createdBy param too, but can't figure how to pass multiple
+    requests = [events_service.list(calendarId=calendar_address, showDeleted=True,
+                                    privateExtendedProperty=f"{SOURCE_EVENT_KEY}={source_event_id}")
+                for source_event_id in source_event_ids]
+    target_events = []
+    for response, exception in execute_batched(requests, "calendar.lookup"):
+        if exception is not None:
+            raise exception
+        target_events.extend(response['items'])
+    return _index_by_source(target_events)
+
 
-    return matches[0]
+def fetch_target_events_by_source(events_service: discovery.Resource, calendar_address: str,
+                                  min_end_time: Optional[datetime] = None) -> Dict[str, Dict[str, Any]]:
+    """Retrieve all calendupe events on the target calendar, keyed by the ID of the source event they were created from.
+
+    :param events_service: a Google Calendar Events Python Service
+    :param calendar_address: address of the target calendar, e.g. 'primary' or 'you@your.domain'
+    :param min_end_time: the minimum time (of event end) of events to retrieve
+    """
+    target_events, _ = list_events(events_service, calendar_address, min_end_time=min_end_time,
+                                   only_calendupe_events=True, show_deleted=True)
+    return _index_by_source(target_events)
 
 
 def duplicate_events(events_service: discovery.Resource, source_calendar_address: str, target_calendar_address: str,
@@ -141,46 +222,66 @@ def duplicate_events(events_service: discovery.Resource, source_calendar_address
     if source_calendar_address == target_calendar_address and not allow_same_calendar:
         raise ValueError(f"Cannot duplicate events to same calendar unless allow_same_calendar is True")
 
+    full_sync = sync_token is None
     try:
         events, next_sync_token = list_events(events_service, source_calendar_address, sync_token,
                                               min_end_time=min_end_time)
     except HttpError as e:
         # this indicates the sync token has been invalided by server (e.g. expired)
         if e.status_code == 410:
-            logger.info(f"sync token has been invalidated")
-            delete_all_calendupe_events(events_service, target_calendar_address)
+            full_sync = True
+            logger.info("sync token has been invalidated, resyncing all events")
+            # rather than deleting every calendupe event and recreating them, reconcile against the existing target
+            # events below. including deleted source events lets their target events be cancelled too
             events, next_sync_token = list_events(events_service, source_calendar_address,
-                                                  min_end_time=min_end_time)
+                                                  min_end_time=min_end_time, show_deleted=True)
         else:
             raise e
 
-    # iterate through
+    if len(events) == 0:
+        logger.info("found no changed events in source calendar")
+        return next_sync_token
+
+    # a full sync covers most target events, so list them all at once. an incremental sync only needs the target events
+    # for the changed source events
+    if full_sync:
+        target_events_by_source = fetch_target_events_by_source(events_service, target_calendar_address,
+                                                                min_end_time=min_end_time)
+    else:
+        target_events_by_source = fetch_target_events(events_service, target_calendar_address,
+                                                      [event['id'] for event in events])
+
+    # work out which target events need creating or updating
+    mutations = []
     created_count = 0
     updated_count = 0
     for source_event in events:
+        existing_target_event = target_events_by_source.get(source_event['id'])
+        if existing_target_event is None and source_event.get('status') == "cancelled":
+            # if the source event is cancelled and there's no target event, nothing to do
+            continue
         expected_target_event = source_event_to_target_event(source_event)
-        existing_target_event = fetch_target_event(events_service, calendar_address=target_calendar_address,
-                                                   source_event_id=source_event['id'])
         if existing_target_event is None:
-            if expected_target_event['status'] == "cancelled":
-                # if the source event is cancelled and there's no target event, nothing to do
-                continue
             # but if the source event isn't cancelled and there's no target event, create one
-            create_event(events_service, calendar_address=target_calendar_address, event=expected_target_event)
+            mutations.append(events_service.insert(calendarId=target_calendar_address, body=expected_target_event))
             created_count += 1
         else:
             # if it does exist, check if matches
-            existing_target_matches = True
-            for target_key in expected_target_event.keys():
-                if existing_target_event[target_key] != expected_target_event[target_key]:
-                    existing_target_matches = False
-                    break
+            existing_target_matches = all(existing_target_event.get(key) == value
+                                          for key, value in expected_target_event.items())
             # if they're different, update the existing one
             if not existing_target_matches:
                 expected_target_event['id'] = existing_target_event['id']
-                update_event(events_service, calendar_address=target_calendar_address,
-                             event=expected_target_event)
+                mutations.append(events_service.patch(calendarId=target_calendar_address,
+                                                      eventId=existing_target_event['id'], body=expected_target_event))
                 updated_count += 1
+
+    # send creates and updates in batches, failing afterwards so the sync token isn't advanced past missed changes
+    errors = [exception for _, exception in execute_batched(mutations, "calendar.write") if exception is not None]
+    for error in errors:
+        logger.error(f"failed to write target event: {error}")
+    if len(errors) > 0:
+        raise errors[0]
     logger.info(f"found {len(events)} events in source calendar, created {created_count} and updated {updated_count} "
                 f"in target calendar")
     return next_sync_token